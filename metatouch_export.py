@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# ==============================================================================
+"""
+Author: Abhipol Vibhatasilpin (abhipol@umich.edu)
+Description: Packs recorded captures and labeled stream frames from one or
+             more sessions into shuffled, fixed-size shards for training
+
+Usage: python metatouch_export.py OUTPUT_DIR SESSION_DIR [SESSION_DIR ...]
+
+"""
+# ==============================================================================
+
+import os
+import sys
+import json
+import argparse
+import configparser
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+from metatouch_pipeline import (TRANSITIONS_FILE, label_frames,
+                                list_stream, list_captures,
+                                parse_stream_name, parse_capture_name,
+                                read_transitions)
+
+# ==============================================================================
+# Read in configuration
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+CLASSES = config['DATA']['CLASSES'][1:-1].split(', ')
+
+# ==============================================================================
+
+# Fixed label vocabularies, named the way on_spacebar names labels. Stream
+# labels are indexed by transition_state
+CLASS_LABELS = [label.lower().strip().replace(" ", "_") for label in CLASSES]
+STATE_LABELS = ["no_touch", "touch"]
+LABEL_NAMES = {"capture": CLASS_LABELS, "stream": STATE_LABELS}
+METADATA_FILE = "metadata.json"
+INDEX_FILE = "index.csv"
+
+# ==============================================================================
+
+def session_keys(sessions):
+    """Returns a unique name for every session directory.
+
+    Sessions are named by their path relative to the common parent, so
+    a/s1 and b/s1 stay apart while a single session keeps its own name.
+    """
+    paths = [os.path.abspath(session) for session in sessions]
+    if len(set(paths)) != len(paths):
+        raise ValueError("a session directory was given more than once")
+    parent = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return {session: os.path.relpath(path, parent)
+            for session, path in zip(sessions, paths)}
+
+
+def collect_samples(sessions):
+    """Returns {kind: [(session dir, filename, label), ...]} for all sessions
+    and {kind: sample shape}.
+
+    Raises ValueError if a sample does not match the shape of the first
+    sample of its kind, e.g. sessions recorded with another CAPTURE_SIZE,
+    or if a capture label is not one of the configured CLASSES.
+    """
+    samples = {"capture": [], "stream": []}
+    for session in sessions:
+        for name in list_captures(session):
+            label, _ = parse_capture_name(name)
+            if label not in CLASS_LABELS:
+                raise ValueError(f"{os.path.join(session, name)} has label "
+                                 f"'{label}' which is not in CLASSES "
+                                 f"{CLASS_LABELS}")
+            samples["capture"].append((session, name, label))
+
+        stream = list_stream(session)
+        timestamps = [parse_stream_name(name)[1] for name in stream]
+        transitions = read_transitions(os.path.join(session, TRANSITIONS_FILE))
+        states = label_frames(timestamps, *transitions)
+        for name, state in zip(stream, states):
+            samples["stream"].append((session, name, STATE_LABELS[state]))
+
+    shapes = {}
+    for kind, members in samples.items():
+        for session, name, _ in members:
+            path = os.path.join(session, name)
+            shape = np.load(path, mmap_mode='r').shape
+            expected = shapes.setdefault(kind, shape)
+            if shape != expected:
+                raise ValueError(f"{path} has shape {shape}, expected "
+                                 f"{expected} like the other {kind} samples")
+    return samples, shapes
+
+
+def write_shard(task):
+    """Loads one shard worth of samples and writes it as a single array."""
+    path, shape, samples, label_ids = task
+    data = np.empty((len(samples),) + shape, dtype=np.float32)
+    labels = np.empty(len(samples), dtype=np.int32)
+    for i, (session, name, label) in enumerate(samples):
+        data[i] = np.load(os.path.join(session, name))
+        labels[i] = label_ids[label]
+    np.save(path + ".npy", data)
+    np.save(path + "_labels.npy", labels)
+    return path
+
+
+def export(dst, sessions, shard_mb=64, seed=0, workers=None):
+    """Shuffles every sample across sessions and writes them out in shards."""
+    os.makedirs(dst, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    keys = session_keys(sessions)
+    metadata = {"seed": seed, "sessions": {keys[session]:
+                                           os.path.abspath(session)
+                                           for session in sessions}}
+    tasks = []
+    index = []
+    samples_by_kind, shapes = collect_samples(sessions)
+    for kind, samples in samples_by_kind.items():
+        if not samples:
+            continue
+        shape = shapes[kind]
+        sample_bytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        shard_size = max(shard_mb * 2**20 // sample_bytes, 1)
+        labels = LABEL_NAMES[kind]
+        label_ids = {label: i for i, label in enumerate(labels)}
+
+        # Shuffle once up front so training can read the shards sequentially
+        order = rng.permutation(len(samples))
+        shards = []
+        for shard, start in enumerate(range(0, len(samples), shard_size)):
+            members = [samples[i] for i in order[start:start + shard_size]]
+            filename = f"{kind}_shard_{shard:05d}"
+            tasks.append((os.path.join(dst, filename), shape, members,
+                          label_ids))
+            shards.append({
+                "file": filename + ".npy",
+                "labels_file": filename + "_labels.npy",
+                "num_samples": len(members),
+                "labels": Counter(label for _, _, label in members),
+                "sessions": Counter(keys[s] for s, _, _ in members),
+            })
+            for offset, (session, name, label) in enumerate(members):
+                index.append((start + offset, kind, shard, offset, label,
+                              keys[session], name))
+
+        metadata[kind] = {
+            "shape": list(shape),
+            "dtype": "float32",
+            "shard_size": shard_size,
+            "num_samples": len(samples),
+            "label_names": labels,
+            "labels": Counter(label for _, _, label in samples),
+            "sessions": Counter(keys[s] for s, _, _ in samples),
+            "shards": shards,
+        }
+
+    with Pool(workers) as pool:
+        for _ in pool.imap_unordered(write_shard, tasks):
+            pass
+
+    with open(os.path.join(dst, INDEX_FILE), "w") as f:
+        f.write("position\tkind\tshard\toffset\tlabel\tsession\tfilename\n")
+        for row in index:
+            f.write("\t".join(str(value) for value in row) + "\n")
+    with open(os.path.join(dst, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def read_shards(directory, kind="capture"):
+    """Yields (data, labels) for each shard of kind in shuffled order.
+
+    Shards are memory mapped, iterate over data in order to keep the reads
+    sequential.
+    """
+    with open(os.path.join(directory, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    for shard in metadata.get(kind, {}).get("shards", []):
+        data = np.load(os.path.join(directory, shard["file"]), mmap_mode='r')
+        labels = np.load(os.path.join(directory, shard["labels_file"]))
+        yield data, labels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export MetaTouch sessions as shuffled training shards.")
+    parser.add_argument("dst", help="directory to write the shards to")
+    parser.add_argument("sessions", nargs="+",
+                        help="recorded session directories")
+    parser.add_argument("-m", "--shard-mb", type=int, default=64,
+                        help="approximate shard size in MB (default: 64)")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="shuffle seed (default: 0)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: cpu count)")
+    args = parser.parse_args(argv)
+
+    for option in ("shard_mb", "workers"):
+        value = getattr(args, option)
+        if value is not None and value < 1:
+            parser.error(f"--{option.replace('_', '-')} must be at least 1")
+
+    metadata = export(args.dst, args.sessions, args.shard_mb, args.seed,
+                      args.workers)
+    for kind in ("capture", "stream"):
+        if kind in metadata:
+            print(f"Exported {metadata[kind]['num_samples']} {kind} samples "
+                  f"in {len(metadata[kind]['shards'])} shards to {args.dst}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
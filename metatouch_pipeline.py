@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# ==============================================================================
+"""
+Author: Abhipol Vibhatasilpin (abhipol@umich.edu)
+Description: Decode, smoothing and labeling stages shared by the live
+             MetaTouch plotter and the offline reprocessing tool
+
+"""
+# ==============================================================================
+
+import os
+from collections import deque
+
+import numpy as np
+import pandas
+
+# ==============================================================================
+# Wire format of a single frame sent by the board
+RAW_SHAPE = (4, 1002)
+FRAME_BYTES = 2 * RAW_SHAPE[0] * RAW_SHAPE[1]
+ADC_MAX = 4095
+ADC_VREF = 3.3
+
+# Recorded file name prefixes
+STREAM_PREFIX = "state_data_batch_"
+RAW_PREFIX = "raw_data_batch_"
+CAPTURE_PREFIX = "training_data_"
+TRANSITIONS_FILE = "transitions.csv"
+
+# ==============================================================================
+
+def decode_frame(buffer):
+    """Converts a raw socket buffer or ADC count array into voltages.
+
+    Float arrays are assumed to be decoded already and are passed through.
+    """
+    if isinstance(buffer, (bytes, bytearray, memoryview)):
+        signal = np.frombuffer(buffer, dtype='<u2')
+    else:
+        signal = np.asarray(buffer)
+        if signal.dtype == np.uint8:
+            signal = np.ascontiguousarray(signal).view('<u2')
+
+    if np.issubdtype(signal.dtype, np.integer):
+        signal = np.reshape(signal, RAW_SHAPE)[:,:-2].astype(np.float32)
+        return signal / ADC_MAX * ADC_VREF
+    return signal
+
+
+class FrameSmoother():
+    """ Moving average over the most recent frames """
+
+    def __init__(self, window, shape=None, seed=None):
+        self.window = max(int(window), 1)
+        self.frames = deque(maxlen=self.window)
+        if seed is not None:
+            for frame in seed:
+                self.frames.append(frame)
+        # The live app starts from an all zero history
+        if shape is not None:
+            while len(self.frames) < self.window:
+                self.frames.appendleft(np.zeros(shape))
+
+    def push(self, frame):
+        """Adds a frame and returns the mean of the current window."""
+        self.frames.append(frame)
+        return np.mean(self.frames, axis=0)
+
+
+def parse_stream_name(filename):
+    """Returns (index, timestamp) from a state_data_batch file name."""
+    stem = os.path.basename(filename)[len(STREAM_PREFIX):-len(".npy")]
+    index, timestamp = stem.split("_", 1)
+    return int(index), float(timestamp)
+
+
+def parse_capture_name(filename):
+    """Returns (label, frame count) from a training_data file name."""
+    stem = os.path.basename(filename)[len(CAPTURE_PREFIX):-len(".npy")]
+    label, num_frame = stem.rsplit("_", 1)
+    return label, int(num_frame)
+
+
+def raw_name(filename):
+    """Returns the raw_data_batch file saved next to a state_data_batch file."""
+    return RAW_PREFIX + os.path.basename(filename)[len(STREAM_PREFIX):]
+
+
+def list_stream(directory):
+    """Returns state_data_batch files in recording order.
+
+    The state index restarts with every run of the plotter, so frames are
+    ordered by timestamp and the index only breaks ties.
+    """
+    names = [name for name in os.listdir(directory)
+             if name.startswith(STREAM_PREFIX) and name.endswith(".npy")]
+    return sorted(names, key=lambda name: parse_stream_name(name)[::-1])
+
+
+def split_runs(names):
+    """Splits ordered stream files wherever the plotter was restarted."""
+    runs = []
+    previous = None
+    for name in names:
+        index, _ = parse_stream_name(name)
+        if previous is None or index <= previous:
+            runs.append([])
+        runs[-1].append(name)
+        previous = index
+    return runs
+
+
+def list_captures(directory):
+    """Returns training_data files ordered by label and frame count."""
+    names = [name for name in os.listdir(directory)
+             if name.startswith(CAPTURE_PREFIX) and name.endswith(".npy")]
+    return sorted(names, key=parse_capture_name)
+
+
+def read_transitions(path):
+    """Loads transitions.csv as sorted (timestamps, states) arrays."""
+    if not os.path.exists(path):
+        return np.array([]), np.array([], dtype=int)
+    df = pandas.read_csv(path, sep='\t', index_col=0)
+    df = df.sort_values("timestamp")
+    return (df["timestamp"].to_numpy(dtype=float),
+            df["transition_state"].to_numpy(dtype=int))
+
+
+def label_frames(timestamps, transition_times, transition_states):
+    """Returns the touch state active at each timestamp (0 before any)."""
+    timestamps = np.asarray(timestamps, dtype=float)
+    if len(transition_times) == 0:
+        return np.zeros(timestamps.shape, dtype=int)
+    position = np.searchsorted(transition_times, timestamps, side='right') - 1
+    states = np.asarray(transition_states)[np.clip(position, 0, None)]
+    return np.where(position < 0, 0, states)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# ==============================================================================
+"""
+Author: Abhipol Vibhatasilpin (abhipol@umich.edu)
+Description: Offscreen rendering of the MetaTouch line plots and spectrograms
+             to a PNG frame sequence or a video, either from a recorded
+             session or from live snapshots handed to a background process
+
+Usage: python metatouch_record.py SESSION_DIR OUTPUT [options]
+
+"""
+# ==============================================================================
+
+import os
+import sys
+import argparse
+import configparser
+import queue
+import shutil
+import subprocess
+import multiprocessing
+from threading import Thread
+
+import numpy as np
+from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from metatouch_pipeline import ADC_VREF, decode_frame, list_stream
+
+# ==============================================================================
+# Read in configuration
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+CHANNELS = config['DATA']['CHANNELS'][1:-1].split(', ')
+NUM_CHANNELS = len(CHANNELS)
+CAPTURE_SIZE = int(config['DATA']['CAPTURE_SIZE'])
+FRAME_LENGTH = int(config['PLOT']['FRAME_LENGTH'])
+INDEX_WIDTH = int(config['PLOT']['INDEX_WIDTH'])
+COLORMAP = config['PLOT']['COLORMAP']
+RECORD_FPS = int(config['RECORD']['FPS'])
+RECORD_WIDTH = int(config['RECORD']['WIDTH'])
+RECORD_HEIGHT = int(config['RECORD']['HEIGHT'])
+RECORD_QUEUE = int(config['RECORD']['QUEUE_SIZE'])
+RECORD_FORMAT = config['RECORD']['FORMAT']
+
+VIDEO_FORMATS = (".mp4", ".avi", ".mkv", ".mov")
+
+# ==============================================================================
+
+# Match the colors of the live plotter
+background = (44/255, 44/255, 46/255)
+foreground = "white"
+
+
+class PlotRenderer():
+    """ Draws the plotter's line plots and spectrograms onto an Agg canvas
+
+    Axes, ticks and labels are drawn once and cached, every frame only
+    redraws the lines and images on top of them.
+    """
+
+    def __init__(self, width=RECORD_WIDTH, height=RECORD_HEIGHT, dpi=100):
+        self.figure = Figure(figsize=(width/dpi, height/dpi), dpi=dpi,
+                             facecolor=(28/255, 28/255, 30/255))
+        self.canvas = FigureCanvasAgg(self.figure)
+        grid = self.figure.add_gridspec(2, NUM_CHANNELS, height_ratios=[3, 7])
+
+        self.lines = []
+        self.images = []
+        self.artists = []
+        for i in range(NUM_CHANNELS):
+            lineplot = self.figure.add_subplot(grid[0, i])
+            line, = lineplot.plot(np.zeros(INDEX_WIDTH), linewidth=1.5)
+            lineplot.set_title(CHANNELS[i], color=foreground, fontweight='bold')
+            lineplot.set_xlim(0, INDEX_WIDTH)
+            lineplot.set_ylim(0, ADC_VREF)
+            lineplot.set_xlabel('Index')
+            lineplot.set_ylabel('Voltage (V)')
+            self.lines.append(line)
+
+            spectrogram = self.figure.add_subplot(grid[1, i])
+            image = spectrogram.imshow(np.zeros((FRAME_LENGTH, INDEX_WIDTH)),
+                                       cmap=COLORMAP, origin='lower',
+                                       aspect='auto', interpolation='nearest',
+                                       extent=(0, INDEX_WIDTH, 0, FRAME_LENGTH))
+            marker = spectrogram.axhline(FRAME_LENGTH - CAPTURE_SIZE,
+                                         color='yellow')
+            spectrogram.set_xlabel('Index')
+            spectrogram.set_ylabel('Frame')
+            self.images.append(image)
+            self.artists.extend((line, image, marker))
+
+            for axes in (lineplot, spectrogram):
+                axes.set_facecolor(background)
+                axes.tick_params(colors=foreground)
+                axes.xaxis.label.set_color(foreground)
+                axes.yaxis.label.set_color(foreground)
+
+        self.figure.tight_layout()
+        for artist in self.artists:
+            artist.set_animated(True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.size = self.canvas.get_width_height()
+
+    def draw(self, snapshot):
+        """Draws a (channels, FRAME_LENGTH, INDEX_WIDTH) spectrogram stack.
+
+        The newest row of each spectrogram is the line plot data. Returns
+        the rendered frame as an RGBA array.
+        """
+        for line, image, channel in zip(self.lines, self.images, snapshot):
+            line.set_ydata(channel[-1])
+            image.set_data(channel)
+            image.autoscale()
+        self.canvas.restore_region(self.background)
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+        return np.asarray(self.canvas.buffer_rgba())
+
+
+def check_output(output):
+    """Raises RuntimeError if output needs an encoder that is missing or is
+    a frame directory that already holds files."""
+    if output.lower().endswith(VIDEO_FORMATS):
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg is required to write " + output)
+    elif os.path.isdir(output) and os.listdir(output):
+        raise RuntimeError(output + " is not empty")
+
+
+class FrameSink():
+    """ Writes rendered frames as a video or a numbered PNG sequence """
+
+    def __init__(self, output, size, fps=RECORD_FPS):
+        self.output = output
+        self.count = 0
+        self.encoder = None
+        check_output(output)
+        if output.lower().endswith(VIDEO_FORMATS):
+            width, height = size
+            self.encoder = subprocess.Popen(
+                ["ffmpeg", "-loglevel", "error", "-y",
+                 "-f", "rawvideo", "-pix_fmt", "rgba",
+                 "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+                 "-pix_fmt", "yuv420p", output],
+                stdin=subprocess.PIPE)
+        else:
+            os.makedirs(output, exist_ok=True)
+
+    def write(self, frame):
+        if self.encoder is not None:
+            self.encoder.stdin.write(frame.tobytes())
+        else:
+            filename = os.path.join(self.output, f"frame_{self.count:06d}.png")
+            Image.fromarray(frame).save(filename, compress_level=1)
+        self.count += 1
+
+    def close(self):
+        if self.encoder is not None:
+            self.encoder.stdin.close()
+            if self.encoder.wait() != 0:
+                raise RuntimeError("ffmpeg exited with status "
+                                   f"{self.encoder.returncode}")
+
+
+def recording_name(stem, fmt=RECORD_FORMAT):
+    """Returns the output path for a recording in the configured format."""
+    if fmt.lower() == "png":
+        return stem
+    return f"{stem}.{fmt.lower()}"
+
+
+def encode(frames, results, output, fps=RECORD_FPS):
+    """Renders every snapshot from frames until a None sentinel is read.
+
+    Puts (frames written, error message or None) on results when done.
+    """
+    sink = None
+    error = None
+    try:
+        renderer = PlotRenderer()
+        sink = FrameSink(output, renderer.size, fps)
+        while True:
+            snapshot = frames.get()
+            if snapshot is None:
+                break
+            sink.write(renderer.draw(snapshot))
+        sink.close()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    results.put((sink.count if sink is not None else 0, error))
+
+
+class Recorder():
+    """ Hands live snapshots to a background encoder process
+
+    Snapshots are offered without blocking. When the encoder falls behind
+    and the bounded queue is full, the snapshot is dropped from the
+    recording instead of stalling the GUI thread. Stopping is not blocking
+    either, poll finished() and then read written and error.
+    """
+
+    def __init__(self, output, fps=RECORD_FPS, queue_size=RECORD_QUEUE):
+        check_output(output)
+
+        # Spawn so the encoder does not inherit the Qt application
+        context = multiprocessing.get_context("spawn")
+        self.output = output
+        self.frames = context.Queue(maxsize=queue_size)
+        self.results = context.SimpleQueue()
+        self.process = context.Process(target=encode,
+                                       args=(self.frames, self.results,
+                                             output, fps),
+                                       daemon=True)
+        self.process.start()
+        self.closer = None
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.error = None
+
+    def offer(self, snapshot):
+        """Queues a snapshot, returns False if it had to be dropped."""
+        if self.closer is not None:
+            return False
+        try:
+            self.frames.put_nowait(np.asarray(snapshot, dtype=np.float32))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.recorded += 1
+        return True
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        """Lets the encoder finish the queued snapshots in the background."""
+        if self.closer is None:
+            self.closer = Thread(target=self.finish, daemon=True)
+            self.closer.start()
+
+    def finished(self):
+        return self.closer is not None and not self.closer.is_alive()
+
+    def wait(self, timeout=None):
+        """Stops the recording and blocks until the encoder has exited."""
+        self.stop()
+        self.closer.join(timeout)
+
+    def finish(self):
+        # The queue may be full, keep offering the sentinel while the
+        # encoder is still there to drain it
+        while self.process.is_alive():
+            try:
+                self.frames.put(None, timeout=0.5)
+                break
+            except queue.Full:
+                pass
+        self.process.join()
+        # Whatever is left has no reader, do not block exit flushing it
+        self.frames.cancel_join_thread()
+
+        if not self.results.empty():
+            self.written, self.error = self.results.get()
+        if self.error is None and self.process.exitcode != 0:
+            self.error = f"encoder exited with status {self.process.exitcode}"
+
+
+def render_session(src, output, fps=RECORD_FPS, stride=1):
+    """Renders a recorded stream, drawing every stride-th stream frame."""
+    renderer = PlotRenderer()
+    sink = FrameSink(output, renderer.size, fps)
+    snapshot = np.zeros((NUM_CHANNELS, FRAME_LENGTH, INDEX_WIDTH))
+    try:
+        for i, name in enumerate(list_stream(src)):
+            # Roll each spectrogram the same way SpectrogramWidget does
+            snapshot = np.roll(snapshot, -1, 1)
+            snapshot[:, -1] = decode_frame(np.load(os.path.join(src, name)))
+            if i % stride == 0:
+                sink.write(renderer.draw(snapshot))
+    finally:
+        sink.close()
+    return sink.count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render a recorded MetaTouch session to video or PNGs.")
+    parser.add_argument("src", help="directory holding the recorded session")
+    parser.add_argument("output", help="video file (" + ", ".join(VIDEO_FORMATS)
+                        + ") or directory for a PNG sequence")
+    parser.add_argument("-r", "--fps", type=int, default=RECORD_FPS,
+                        help=f"output frame rate (default: {RECORD_FPS})")
+    parser.add_argument("-s", "--stride", type=int, default=1,
+                        help="render every n-th stream frame (default: 1)")
+    args = parser.parse_args(argv)
+
+    for option in ("fps", "stride"):
+        if getattr(args, option) < 1:
+            parser.error(f"--{option} must be at least 1")
+    try:
+        check_output(args.output)
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    count = render_session(args.src, args.output, args.fps, args.stride)
+    print(f"Rendered {count} frames to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
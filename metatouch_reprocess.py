@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# ==============================================================================
+"""
+Author: Abhipol Vibhatasilpin (abhipol@umich.edu)
+Description: Reruns the MetaTouch decode, smoothing and labeling pipeline
+             over a recorded session directory in a process pool
+
+Usage: python metatouch_reprocess.py SESSION_DIR OUTPUT_DIR [options]
+
+"""
+# ==============================================================================
+
+import os
+import sys
+import json
+import argparse
+import configparser
+import shutil
+from multiprocessing import Pool
+
+import numpy as np
+
+from metatouch_pipeline import (TRANSITIONS_FILE, FrameSmoother,
+                                decode_frame, label_frames,
+                                list_stream, list_captures, split_runs,
+                                raw_name, parse_stream_name,
+                                parse_capture_name, read_transitions)
+
+# ==============================================================================
+# Read in configuration
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+SMOOTHING_WINDOW = int(config['DATA']['SMOOTHING_WINDOW'])
+
+METADATA_FILE = "reprocess.json"
+
+# ==============================================================================
+
+def has_raw(src, names):
+    """True if every stream frame has its unsmoothed raw_data_batch file."""
+    return bool(names) and all(os.path.exists(os.path.join(src, raw_name(name)))
+                               for name in names)
+
+
+def stream_tasks(src, dst, names, window, chunk_size, transitions, raw):
+    """Splits the stream into chunks that carry their smoothing history.
+
+    History never crosses a restart of the plotter, the first chunk of
+    every run starts from zeros like the live app does.
+    """
+    overlap = max(window - 1, 0)
+    for run in split_runs(names):
+        for start in range(0, len(run), chunk_size):
+            history = run[max(start - overlap, 0):start]
+            chunk = run[start:start + chunk_size]
+            yield (src, dst, history, chunk, window, transitions, raw)
+
+
+def load_stream_frame(src, name, raw):
+    if raw:
+        name = raw_name(name)
+    return decode_frame(np.load(os.path.join(src, name)))
+
+
+def process_stream_chunk(task):
+    """Decodes, smooths and labels one chunk of stream frames."""
+    src, dst, history, chunk, window, transitions, raw = task
+    seed = [load_stream_frame(src, name, raw) for name in history]
+    smoother = None
+    rows = []
+    for name in chunk:
+        signal = load_stream_frame(src, name, raw)
+        if smoother is None:
+            smoother = FrameSmoother(window, signal.shape, seed)
+        np.save(os.path.join(dst, name), smoother.push(signal))
+        if raw:
+            # Keep the output reprocessable as well
+            np.save(os.path.join(dst, raw_name(name)), signal)
+        rows.append((name,) + parse_stream_name(name))
+
+    timestamps = [row[2] for row in rows]
+    states = label_frames(timestamps, *transitions)
+    return [row + (int(state),) for row, state in zip(rows, states)]
+
+
+def process_capture(task):
+    """Re-smooths a single training capture along its frames.
+
+    Captures are spectrogram rows in volts, there are no raw ADC counts to
+    decode, so integer captures are rejected.
+    """
+    src, dst, name, window = task
+    capture = np.load(os.path.join(src, name), mmap_mode='r')
+    if not np.issubdtype(capture.dtype, np.floating):
+        raise ValueError(f"{name}: expected a float capture in volts, "
+                         f"got {capture.dtype}")
+    channels = []
+    for channel in capture:
+        rows = list(channel)
+        # Captures have no history before their first row, so warm the
+        # window with it rather than with zeros
+        smoother = FrameSmoother(window, seed=rows[:1] * (window - 1))
+        channels.append([smoother.push(row) for row in rows])
+    np.save(os.path.join(dst, name), np.asarray(channels))
+    return (name,) + parse_capture_name(name)
+
+
+def reprocess(src, dst, window=None, workers=None, chunk_size=256):
+    """Reprocesses every recording in src and writes the result to dst.
+
+    Stream frames are smoothed from their raw_data_batch files when the
+    session has them for every frame. Otherwise the recorded frames already
+    carry the live smoothing and window only adds extra smoothing on top.
+    Without a window, raw sessions use SMOOTHING_WINDOW and others use 1.
+    Returns the metadata that is also written to reprocess.json.
+    """
+    os.makedirs(dst, exist_ok=True)
+    transitions = read_transitions(os.path.join(src, TRANSITIONS_FILE))
+    if os.path.exists(os.path.join(src, TRANSITIONS_FILE)):
+        shutil.copy(os.path.join(src, TRANSITIONS_FILE), dst)
+
+    stream = list_stream(src)
+    captures = list_captures(src)
+    raw = has_raw(src, stream)
+    if window is None:
+        window = SMOOTHING_WINDOW if raw else 1
+
+    metadata = {
+        "stream_source": "raw" if raw else "smoothed",
+        "smoothing_window": window,
+        # Stream runs start from zeros like the live app, captures have no
+        # history so their window is filled with the first row instead
+        "stream_warmup": "zeros",
+        "capture_warmup": "first_row",
+        "num_stream": len(stream),
+        "num_captures": len(captures),
+    }
+
+    with Pool(workers) as pool:
+        tasks = stream_tasks(src, dst, stream, window, chunk_size,
+                             transitions, raw)
+        with open(os.path.join(dst, "stream_labels.csv"), "w") as f:
+            f.write("filename\tstate_index\ttimestamp\ttransition_state\n")
+            for rows in pool.imap(process_stream_chunk, tasks):
+                for row in rows:
+                    f.write("\t".join(str(value) for value in row) + "\n")
+
+        tasks = ((src, dst, name, window) for name in captures)
+        with open(os.path.join(dst, "capture_labels.csv"), "w") as f:
+            f.write("filename\tlabel\tnum_frame\n")
+            for row in pool.imap(process_capture, tasks, chunksize=8):
+                f.write("\t".join(str(value) for value in row) + "\n")
+
+    with open(os.path.join(dst, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Rerun the MetaTouch preprocessing over a recorded session.")
+    parser.add_argument("src", help="directory holding the recorded session")
+    parser.add_argument("dst", help="directory to write reprocessed files to")
+    parser.add_argument("-w", "--smoothing", type=int, default=None,
+                        help="moving average window in frames (default: "
+                             f"{SMOOTHING_WINDOW} when the session has raw "
+                             "frames, otherwise 1 since the recorded frames "
+                             "already carry the live smoothing)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: cpu count)")
+    parser.add_argument("-c", "--chunk-size", type=int, default=256,
+                        help="stream frames per task (default: 256)")
+    args = parser.parse_args(argv)
+
+    for option in ("smoothing", "workers", "chunk_size"):
+        value = getattr(args, option)
+        if value is not None and value < 1:
+            parser.error(f"--{option.replace('_', '-')} must be at least 1")
+    if os.path.abspath(args.src) == os.path.abspath(args.dst):
+        parser.error("output directory must differ from the session directory")
+
+    metadata = reprocess(args.src, args.dst, args.smoothing, args.workers,
+                         args.chunk_size)
+    print(f"Reprocessed {metadata['num_stream']} stream frames "
+          f"({metadata['stream_source']}, window "
+          f"{metadata['smoothing_window']}) and {metadata['num_captures']} "
+          f"captures into {args.dst}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
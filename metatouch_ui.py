@@ -22,6 +22,7 @@ import configparser
 import subprocess
 import socket
 from threading import Event, Thread
+from multiprocessing import freeze_support
 from datetime import datetime
 
 # Data processing
@@ -40,6 +41,9 @@ import pyqtgraph as pg
 
 # Custom
 from metatouch_label import ClassLabelWidget, StateLabelWidget
+from metatouch_pipeline import (FRAME_BYTES, STREAM_PREFIX, RAW_PREFIX,
+                                FrameSmoother, decode_frame)
+from metatouch_record import Recorder, RECORD_FPS, recording_name
 
 # ==============================================================================
 # Read in configuration
@@ -53,6 +57,7 @@ NUM_CHANNELS = len(CHANNELS)
 CLASSES = config['DATA']['CLASSES'][1:-1].split(', ') 
 CAPTURE_SIZE = int(config['DATA']['CAPTURE_SIZE'])
 BATCH_SIZE = int(config['DATA']['BATCH_SIZE'])
+SMOOTHING_WINDOW = int(config['DATA']['SMOOTHING_WINDOW'])
 FRAME_LENGTH = int(config['PLOT']['FRAME_LENGTH'])
 INDEX_WIDTH = int(config['PLOT']['INDEX_WIDTH'])
 COLORMAP = config['PLOT']['COLORMAP']
@@ -90,6 +95,8 @@ class MetaTouch(QtWidgets.QMainWindow):
         self.num_frames = 0
         self.state_index = 0
         self.streaming = False
+        self.recorder = None
+        self.finishing = []
 
         self.labels = ClassLabelWidget(CLASSES) 
         self.states = StateLabelWidget(["No Touch", "Touch"])
@@ -216,6 +223,12 @@ class MetaTouch(QtWidgets.QMainWindow):
         self.fps_timer.timeout.connect(self.update_fps)
         self.fps_timer.start(FPS_TICK_RATE * 1000)
 
+        self.record_timer = QtCore.QTimer()
+        self.record_timer.timeout.connect(self.record_frame)
+
+        self.finish_timer = QtCore.QTimer()
+        self.finish_timer.timeout.connect(self.check_recordings)
+
         # Apply theme
         self.set_appearance()
 
@@ -262,6 +275,9 @@ class MetaTouch(QtWidgets.QMainWindow):
         # S 
         elif event.key()==Qt.Key_S:
             self.on_s()
+        # R
+        elif event.key()==Qt.Key_R:
+            self.on_r()
 
         if not self.streaming:
             # SpaceBar
@@ -282,15 +298,18 @@ class MetaTouch(QtWidgets.QMainWindow):
             # Key Right
             elif event.key()==Qt.Key_Right:
                 self.on_down()
-        else:
+        elif event.key() not in (Qt.Key_Q, Qt.Key_P, Qt.Key_C, Qt.Key_S,
+                                 Qt.Key_R):
             self.footer.setText("Invalid Keyboard Input.")
     
     def on_q(self):
         """ Q for quit """
         df = pandas.DataFrame(self.state_data)
         df.to_csv("transitions.csv", sep='\t')  
+        self.stop_recording()
         self.ds.socket.close()
         self.ds.kill_socket.set()
+        self.wait_recordings()
         sys.exit()
 
     def on_p(self):
@@ -300,6 +319,58 @@ class MetaTouch(QtWidgets.QMainWindow):
         screenshot.save(filename + ".png")
         self.footer.setText("Printed to " + filename)
     
+    def on_r(self):
+        """ R for start/stop recording """
+        if self.recorder is None:
+            filename = datetime.now().strftime("%Y_%m_%d-%I_%M_%S")
+            try:
+                self.recorder = Recorder(recording_name(filename))
+            except RuntimeError as e:
+                self.footer.setText(str(e))
+                return
+            self.record_timer.start(int(1000 / RECORD_FPS))
+            self.footer.setText("Recording to " + self.recorder.output)
+        else:
+            self.stop_recording()
+
+    def record_frame(self):
+        """ Hands the current plots to the background encoder """
+        snapshot = np.stack([spectrogram.img_array
+                             for spectrogram in self.spectrograms])
+        if self.recorder.alive():
+            self.recorder.offer(snapshot)
+        else:
+            self.stop_recording()
+
+    def stop_recording(self):
+        """ Lets the encoder flush in the background and reports when done """
+        if self.recorder is None:
+            return
+        self.record_timer.stop()
+        self.recorder.stop()
+        self.finishing.append(self.recorder)
+        self.footer.setText("Finishing recording to " + self.recorder.output)
+        self.recorder = None
+        self.finish_timer.start(200)
+
+    def check_recordings(self):
+        for recorder in [r for r in self.finishing if r.finished()]:
+            self.finishing.remove(recorder)
+            if recorder.error is None:
+                self.footer.setText(f"Recorded {recorder.written} frames to "
+                                    f"{recorder.output} "
+                                    f"({recorder.dropped} dropped)")
+            else:
+                self.footer.setText(f"Recording to {recorder.output} "
+                                    f"failed: {recorder.error}")
+        if not self.finishing:
+            self.finish_timer.stop()
+
+    def wait_recordings(self):
+        """ Blocks until every recording is written, only used on exit """
+        for recorder in self.finishing:
+            recorder.wait()
+
     def on_c(self):
         """ C for clear plots """
         for i in range(NUM_CHANNELS):
@@ -352,7 +423,10 @@ class MetaTouch(QtWidgets.QMainWindow):
 
     def save_stream(self, batch):
         if self.streaming:
-            np.save(f"state_data_batch_{self.state_index}_{time.time()}.npy", batch)
+            # Keep the unsmoothed frame too so the session can be reprocessed
+            stem = f"{self.state_index}_{time.time()}.npy"
+            np.save(STREAM_PREFIX + stem, batch[0])
+            np.save(RAW_PREFIX + stem, batch[1].astype(np.float32))
             self.states.add_frames_current_label(BATCH_SIZE)
             self.state_index += BATCH_SIZE 
 
@@ -406,6 +480,9 @@ class MetaTouch(QtWidgets.QMainWindow):
     def closeEvent(self,e):
         df = pandas.DataFrame(self.state_data)
         df.to_csv("transitions.csv", sep='\t')  
+        self.stop_recording()
+        self.ds.kill_socket.set()
+        self.wait_recordings()
         e.accept()
 
 class DataSource():
@@ -420,20 +497,20 @@ class DataSource():
         self.kill_socket = Event()
         self.slice = np.zeros((NUM_CHANNELS, INDEX_WIDTH))
         self.queue = deque()
-        self.queue.append(self.slice)
+        self.queue.append((self.slice, self.slice))
         self.batch = []
         self.batch_index = 0
 
     def read_channels(self):
         for i in range(NUM_CHANNELS):
-            self.signal[2*i].emit(self.queue[-1][i])
-            self.signal[2*i + 1].emit(self.queue[-1][i])
+            self.signal[2*i].emit(self.queue[-1][0][i])
+            self.signal[2*i + 1].emit(self.queue[-1][0][i])
        
         if self.batch_index < BATCH_SIZE:
             self.batch.append(self.slice)
             self.batch_index += 1
         else:
-            self.export_data.emit(self.queue[-1])
+            self.export_data.emit(np.stack(self.queue[-1]))
             self.batch = []
             self.batch_index = 0
 
@@ -445,24 +522,17 @@ class DataSource():
 
     def run_conn_stat(self, conn):
         conn.settimeout(3)
-        self.frames = np.zeros((5,NUM_CHANNELS,INDEX_WIDTH))
+        self.smoother = FrameSmoother(SMOOTHING_WINDOW, (NUM_CHANNELS,INDEX_WIDTH))
         while not self.kill_socket.is_set():
             try:          
                 if self.kill_socket.is_set(): 
                     break
-                signal = np.array([])
-                bytes_received = 0
-                while(bytes_received < 2 * 4008):
-                    message = conn.recv(2 * 4008 - bytes_received)
-                    temp = np.frombuffer(message, dtype=np.uint8)
-                    signal = np.hstack((signal, temp))
-                    bytes_received += temp.shape[0]
-                signal = np.asarray(signal, dtype='<B').view(np.uint16)
-                signal = np.reshape(signal, (4, 1002))[:,:-2].astype(np.float32) / 4095 * 3.3
-                self.frames = np.vstack((self.frames, np.expand_dims(signal, axis=0)))
-                self.frames = np.delete(self.frames, 0, axis=0)
-                self.slice = np.mean(self.frames, axis=0)
-                self.queue.append(self.slice)
+                buffer = bytearray()
+                while(len(buffer) < FRAME_BYTES):
+                    buffer += conn.recv(FRAME_BYTES - len(buffer))
+                signal = decode_frame(buffer)
+                self.slice = self.smoother.push(signal)
+                self.queue.append((self.slice, signal))
                 self.export_fps.emit(1) 
 
             except socket.timeout:
@@ -547,6 +617,7 @@ class LineplotWidget(pg.PlotWidget):
         self.line.setData(layer)
 
 if __name__ == '__main__':
+    freeze_support()
     app = QtWidgets.QApplication(sys.argv)
     mt = MetaTouch()
     app.setStyle("Fusion")
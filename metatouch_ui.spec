@@ -5,7 +5,7 @@ block_cipher = None
 
 
 a = Analysis(
-    ['metatouch_ui.py', 'metatouch_label.py'],
+    ['metatouch_ui.py', 'metatouch_label.py', 'metatouch_pipeline.py', 'metatouch_record.py'],
     pathex=[],
     binaries=[],
     datas=[('metatouch_layout.ui','.'),('config.ini','.')],